@@ -1,4 +1,35 @@
-%matplotlib notebook
-from mpl_toolkits import mplot3d
-import matplotlib.pyplot as plt
+import os
 
+# sample game shipped with the repository, found relative to this file so the script runs from any directory
+_SAMPLE_GAME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "games_db", "CollinMakuza vs EKChessMasterProject.pgn")
+
+
+def main(pgn_path: str = _SAMPLE_GAME_PATH):
+    """
+    This function plots the attack surface of black in the starting position of the given game.
+    :param pgn_path: path to a PGN file, the first game in it is used
+    """
+    # chess, pandas and plotting imports are only paid for when this is run as a script
+    import chess.pgn
+    import matplotlib.pyplot as plt
+
+    from utility_functions import create_XYZ, get_game_as_attack_df
+
+    with open(pgn_path) as pgn_file:
+        game = chess.pgn.read_game(pgn_file)
+
+    game_df = get_game_as_attack_df(game)
+
+    # same sample settings as the notebook
+    X, Y, Z = create_XYZ(attack_matrix=game_df["black"][0],
+                         datapoints_along_square=50)
+
+    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
+    ax.plot_surface(X, Y, Z,
+                    cmap="plasma")
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,88 @@
+import functools
+import multiprocessing
+from typing import Optional, Union
+
 import chess
 import chess.pgn
-import numpy
 import pandas as pd
 import numpy as np
-from math import exp
+
+_COLOR_MAP = {
+    "white": chess.WHITE,
+    "black": chess.BLACK,
+    "w": chess.WHITE,
+    "b": chess.BLACK,
+}
 
 
 def get_occupied_squares_by_color(board: chess.Board,
-                                  color: str):
+                                  color: Union[chess.Color, str]):
     """
     This function returns the list of squares occupied by pieces of the given color on the given board.
     :param board: chess.Board object.
-    :param color: strings "white" or "black"
+    :param color: chess.WHITE or chess.BLACK, or strings "white" / "black" or "w" / "b" (case insensitive)
     :return: list of squares written with
     """
-    if str.lower(color) == "white":
-        color = chess.WHITE
-    elif str.lower(color) == "black":
-        color = chess.BLACK
-    else:
-        return ValueError("parameters of the functions should be white or black (case insensitive)")
+    color = _to_chess_color(color)
+
+    # the board keeps one bitboard per color, iterating it only visits occupied squares
+    return list(chess.scan_forward(board.occupied_co[color]))
 
-    squares = []
-    for square in chess.SQUARES:
-        if board.piece_at(square) is not None and board.piece_at(square).color == color:
-            squares.append(square)
 
-    return squares
+def _to_chess_color(color: Union[chess.Color, str]):
+    """
+    This function translates "white" / "black" or "w" / "b" (case insensitive) to chess.WHITE / chess.BLACK. chess
+    colors are returned unchanged.
+    :param color: chess.WHITE or chess.BLACK, or one of the strings above
+    :return: chess.WHITE or chess.BLACK
+    """
+    if isinstance(color, str):
+        try:
+            return _COLOR_MAP[color.lower()]
+        except KeyError:
+            raise ValueError("parameters of the functions should be white or black (case insensitive)") from None
+
+    return color
+
+
+def _piece_attacks_mask(piece_type: chess.PieceType, color: chess.Color, square: chess.Square,
+                        occupied: chess.Bitboard):
+    """
+    This function looks up the squares attacked by a piece in the attack tables precomputed by the chess package.
+    Knights, kings and pawns only depend on the square, sliding pieces also on the occupancy of their rays.
+    :param piece_type: chess.PAWN, chess.KNIGHT, ...
+    :param color: color of the piece, only used for pawns
+    :param square: square number the piece stands on
+    :param occupied: bitboard of all occupied squares on the board
+    :return: bitboard of the attacked squares
+    """
+    if piece_type == chess.PAWN:
+        return chess.BB_PAWN_ATTACKS[color][square]
+    elif piece_type == chess.KNIGHT:
+        return chess.BB_KNIGHT_ATTACKS[square]
+    elif piece_type == chess.KING:
+        return chess.BB_KING_ATTACKS[square]
+
+    attacks = 0
+    if piece_type in (chess.BISHOP, chess.QUEEN):
+        attacks = chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+    if piece_type in (chess.ROOK, chess.QUEEN):
+        attacks |= (chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] |
+                    chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied])
+    return attacks
+
+
+def _sum_bitboards(bitboards: np.ndarray):
+    """
+    This function counts for each square in how many of the given bitboards it is set. The bitboards are unpacked into
+    one bit plane per square and summed, without looping over the set bits in python.
+    :param bitboards: 1D array of 64-bit bitboards
+    :return: int8 array of length 64 indexed by square number
+    """
+    # little endian bytes and bit order so that bit i of a bitboard lands in column i
+    bits = np.unpackbits(np.asarray(bitboards, dtype="<u8").view(np.uint8), bitorder="little")
+
+    return bits.reshape(-1, 64).sum(axis=0, dtype=np.int8)
 
 
 def square_numb_to_2d_coords(square_numb:int):
@@ -41,57 +97,88 @@ def square_numb_to_2d_coords(square_numb:int):
     ]
 
 
-def get_attack_count_by_color(chess_board: chess.Board, color: str):
+def _get_attacks_by_square(chess_board: chess.Board, color: chess.Color):
+    """
+    This function returns the attack bitboard of every piece of the given color.
+    :param chess_board: board object
+    :param color: chess.WHITE or chess.BLACK
+    :return: uint64 array with the bitboard of the squares attacked by each piece
+    """
+    occupied = chess_board.occupied
+
+    # collected as python ints and converted once, assigning into the array one piece at a time is slower
+    attacks = [
+        _piece_attacks_mask(piece_type, color, square, occupied)
+        for piece_type in chess.PIECE_TYPES
+        for square in chess.scan_forward(chess_board.pieces_mask(piece_type, color))
+    ]
+
+    return np.array(attacks, dtype=np.uint64)
+
+
+def get_attack_count_by_color(chess_board: chess.Board, color: Union[chess.Color, str]):
     """
     This function returns the amount of times each square is attacked by pieces of the given color.
     :param chess_board: board object
-    :param color: "white" or "black"
-    :return: 2D array of each square and how much it is attacked by the given color for that board state
+    :param color: chess.WHITE or chess.BLACK, or strings "white" / "black" or "w" / "b" (case insensitive)
+    :return: (8, 8) int8 array of each square and how much it is attacked by the given color for that board state
     """
 
-    # create zeros 8x8 array
-    attack_count = np.zeros(shape=(8, 8), dtype=numpy.int8)
+    color = _to_chess_color(color)
 
-    # get occupied squares
-    occupied_squares = get_occupied_squares_by_color(chess_board, color)
+    # count all attacks in one pass over the attack bitboards of the pieces
+    attack_count = _sum_bitboards(_get_attacks_by_square(chess_board, color))
 
-    for square in occupied_squares:
-        # get squares that are attacked
-        attacked_squares = chess_board.attacks(square).tolist()
+    # square numbers map row-major onto the 8x8 matrix (see square_numb_to_2d_coords)
+    return attack_count.reshape(8, 8)
 
-        # increment attack count in 2d matrix
-        for square_ in chess.SQUARES:
-            if attacked_squares[square_]:
-                [x, y] = square_numb_to_2d_coords(square_)
-                attack_count[x][y] += 1
 
-    return attack_count
+def _count_attacks_from_fen(fen: str):
+    """
+    This function returns the attack counts of both colors for a position, it is run by the worker processes of
+    get_game_as_attack_df.
+    :param fen: position in FEN notation
+    :return: (white, black) attack counts as returned by get_attack_count_by_color
+    """
+    board = chess.Board(fen)
+
+    return get_attack_count_by_color(board, chess.WHITE), get_attack_count_by_color(board, chess.BLACK)
 
 
-def get_game_as_attack_df(game: chess.pgn.Game):
+def get_game_as_attack_df(game: chess.pgn.Game, processes: Optional[int] = 1):
     """
     This function returns a dataframe which shows for each move, the squares attacked by black pieces and by white
     pieces and how many times.
     :param game: game as read by file
+    :param processes: number of worker processes. with 1 the positions are handled one after the other. with more, or
+    None for one per CPU, the positions are counted in a multiprocessing pool.
     :return: dataframe with move number as indices, and columns ["white", "black"]
     """
     game_board = game.board()
 
-    game_as_attacks_df = pd.DataFrame(columns=["white", "black"])
+    if processes != 1:
+        # playing the moves is cheap, once the positions are known they can be counted independently
+        fens = [game_board.fen()]
+        for move in game.mainline_moves():
+            game_board.push(move)
+            fens.append(game_board.fen())
 
-    game_as_attacks_df.loc[0] = [
-        get_attack_count_by_color(game_board, "white"),
-        get_attack_count_by_color(game_board, "black")
-    ]
+        with multiprocessing.Pool(processes) as pool:
+            whites, blacks = zip(*pool.map(_count_attacks_from_fen, fens))
+
+        return pd.DataFrame({"white": list(whites), "black": list(blacks)})
 
-    for i, move in enumerate(game.mainline_moves()):
+    # starting position first, then the position after each move
+    whites = [get_attack_count_by_color(game_board, chess.WHITE)]
+    blacks = [get_attack_count_by_color(game_board, chess.BLACK)]
+
+    for move in game.mainline_moves():
         game_board.push(move)
-        game_as_attacks_df.loc[i] = [
-            get_attack_count_by_color(game_board, "white"),
-            get_attack_count_by_color(game_board, "black")
-        ]
+        whites.append(get_attack_count_by_color(game_board, chess.WHITE))
+        blacks.append(get_attack_count_by_color(game_board, chess.BLACK))
 
-    return game_as_attacks_df
+    # build the dataframe once instead of growing it row by row
+    return pd.DataFrame({"white": whites, "black": blacks})
 
 
 def coords_to_square_numb(x: int, y: int):
@@ -104,23 +191,21 @@ def coords_to_square_numb(x: int, y: int):
     return x * 8 + y
 
 
-def get_attack_numb_from_2d_coords(X, Y, attack_dict: dict):
+def get_attack_numb_from_2d_coords(X, Y, attack_counts: np.ndarray):
     """
-    Given meshgrids X and Y, this method creates the values for Z by looking up in the attack dicti
-    :param X: meshgrid for X  2D array
-    :param Y: meshgrid for Y  2D array
-    :param attack_dict: dict that contains
-    :return:
+    Given meshgrids X and Y, this method creates the values for Z by looking up in the attack counts
+    :param X: meshgrid for X  2D array, open grids (np.ogrid) are broadcast
+    :param Y: meshgrid for Y  2D array, open grids (np.ogrid) are broadcast
+    :param attack_counts: attack count per square, either the (8, 8) matrix from get_attack_count_by_color or a
+    flat array of length 64 indexed by square number
+    :return: 2D array with the attack count of the square under each point of the meshgrid
     """
 
-    Z = coords_to_square_numb(X, Y)
-
-    # creates the attack meshgrid by changing values in Z
-    for i in range(len(Z)):
-        for j in range(len(Z[0])):
-            Z[i][j] = attack_dict[Z[i][j]]
+    # flattening the (8, 8) matrix gives an array indexed by square number
+    attack_arr = np.asarray(attack_counts).reshape(64)
 
-    return Z
+    # creates the attack meshgrid with a single gather
+    return attack_arr[coords_to_square_numb(X, Y)]
 
 
 def gaussian_3d(x, y,
@@ -130,7 +215,34 @@ def gaussian_3d(x, y,
     var_1 = ((x-peak_position_x)**2)/(2 * spread ** 2)
     var_2 = ((y-peak_position_y)**2)/(2 * spread ** 2)
 
-    return height_of_hill * exp(-(var_1 + var_2))
+    return height_of_hill * np.exp(-(var_1 + var_2))
+
+
+@functools.lru_cache(maxsize=None)
+def _gaussian_hill(datapoints_along_square: int):
+    """
+    This function returns the gaussian hill of height 1 used for one square by create_XYZ. The hill only depends on
+    the number of datapoints, so it is cached and reused across calls, e.g. for every frame of a game.
+    :param datapoints_along_square: number of datapoints along one side of the square
+    :return: read-only float32 2D array of shape (datapoints_along_square, datapoints_along_square)
+    """
+    dal = datapoints_along_square
+
+    # datapoints of the square, rows along x and columns along y, in float32 so np.exp runs on float32 lanes
+    x = np.arange(dal, dtype=np.float32)[:, None]
+    y = np.arange(dal, dtype=np.float32)
+
+    # the peak sits dal / 2 into the square
+    hill = gaussian_3d(x=x, y=y,
+                       height_of_hill=1,
+                       spread=dal / 2,
+                       peak_position_x=dal / 2,
+                       peak_position_y=dal / 2)
+
+    # the cached array is shared between callers
+    hill.setflags(write=False)
+
+    return hill
 
 
 def create_XYZ(attack_matrix, datapoints_along_square: int):
@@ -138,40 +250,26 @@ def create_XYZ(attack_matrix, datapoints_along_square: int):
     Given the attack count matrix, this method outputs a smoothed out gaussian hill folllowing the values of the matrix.
     :param attack_matrix: 2D matrix with count for each square
     :param datapoints_along_square: to smooth out surface of the hill on one square, we create more datapoints to describe a square. this parameter controls how many datapoints are used for one square. the value is the number along one side of the square.
-    :return: (X, Y, Z) where those are the matrices needed for the 3D plot.
+    :return: (X, Y, Z) where those are the matrices needed for the 3D plot. X and Y are read-only views, copy them
+    before writing to them. Z is float32.
     """
 
     dal = datapoints_along_square
     datapoints_along_board = dal * 8
 
-    X = np.arange(0, datapoints_along_board)
-    Y = np.arange(0, datapoints_along_board)
-
-    X, Y = np.meshgrid(X, Y)
-
-    Z = np.zeros(shape=(datapoints_along_board, datapoints_along_board))
-
-    for i in range(8):
-        for j in range(8):
-
-            attack_count = attack_matrix[i][j]
+    # open grids keep X as a single row and Y as a single column, same orientation as np.meshgrid(X, Y)
+    Y, X = np.ogrid[0:datapoints_along_board, 0:datapoints_along_board]
 
-            # defining peak coordinates
-            peak_x = (i * dal) + dal / 2
-            peak_y = (j * dal) + dal / 2
+    # every square has the same hill, only its height changes, so the hill is computed once with height 1
+    hill = _gaussian_hill(dal)
 
-            # define spreads
-            spread = dal / 2
+    # define values by scaling one hill per square with the attack count of that square, float32 is plenty for
+    # plotting and halves the memory of Z
+    Z = np.kron(np.asarray(attack_matrix, dtype=np.float32), hill)
 
-            # define values
-            for k in range(i * dal, (i + 1) * dal):
-                for l in range(j * dal, (j + 1) * dal):
-                    Z[k][l] = gaussian_3d(
-                        x=k, y=l,
-                        height_of_hill=attack_count,
-                        spread=spread,
-                        peak_position_x=peak_x,
-                        peak_position_y=peak_y
-                    )
+    # full-size read-only views for plotting, every row of X (and every column of Y) is the same memory, so they can
+    # be read like the np.meshgrid arrays but not written to
+    X = np.broadcast_to(X, (datapoints_along_board, datapoints_along_board))
+    Y = np.broadcast_to(Y, (datapoints_along_board, datapoints_along_board))
 
     return X, Y, Z